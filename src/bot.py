@@ -2,16 +2,26 @@ import logging
 import os
 import sys
 import pickle
+import queue
 import random
+import signal
+import threading
 import psycopg2  # postgresql python
 import re
 
-from telegram.ext import Filters, CommandHandler, MessageHandler, Updater
+from telegram.ext import Filters, CommandHandler, MessageHandler, TypeHandler, Updater, DispatcherHandlerStop
 import telegram as tg
 from typing import Dict, NewType, Tuple, List
 
 from models import User, User_in_chat, Telegram_chat, Telegram_message, user_from_tg_user
 from postgres_funcs import *
+from replay import Update_recorder, read_updates
+from message_archiver import Message_archiver
+from update_context import Update_context, context_for
+from hot_state import load_hot_state
+from update_log import Recent_updates
+from vote_limiter import Vote_velocity_detector
+from inflight import Inflight_updates
 
 log_level = os.environ.get('LOG_LEVEL')
 level = None
@@ -33,6 +43,13 @@ changelog_url = 'https://schafezp.com/schafezp/txkarmabot/blob/master/CHANGELOG.
 from functools import wraps
 LIST_OF_ADMINS = [65278791]
 
+# handler groups that run before the command handlers in the default group 0
+DUPLICATE_UPDATES_GROUP = -20
+RECORD_UPDATES_GROUP = -10
+UPDATE_CONTEXT_GROUP = -5
+# and one that runs after them
+PROCESSED_UPDATES_GROUP = 10
+
 
 def restricted(func):
     @wraps(func)
@@ -56,7 +73,44 @@ def types(func):
     return wrapped
 
 
-conn = None
+def with_update_context(func):
+    """Passes the Update_context of the update to the handler after update,
+    so the user and chat are resolved once no matter how many handlers run"""
+    @wraps(func)
+    def wrapped(bot, update, *args, **kwargs):
+        ctx = context_for(update)
+        result = func(bot, update, ctx, *args, **kwargs)
+        logger.debug(f"{func.__name__} handled update {ctx.update_id} "
+                     f"{ctx.elapsed() * 1000:.1f}ms after it arrived")
+        return result
+    return wrapped
+
+
+def reject_duplicate_update(bot, update):
+    """Dispatcher middleware that stops updates telegram delivered again"""
+    if recent_updates.seen(update.update_id):
+        logger.info(f"Ignoring update {update.update_id}, it was already processed")
+        raise DispatcherHandlerStop()
+
+
+def mark_update_processed(bot, update):
+    """Runs after every other handler group so the update counts as processed"""
+    hot_state.processed_update(update.update_id)
+
+
+def save_snapshot(bot, job):
+    """Job that writes hot_state to SNAPSHOT_FILE, job.context is its own connection"""
+    watermark = get_snapshot_watermark(job.context)
+    hot_state.save(snapshot_file, watermark)
+    logger.debug(f"Saved snapshot at watermark {watermark}")
+
+
+def attach_update_context(bot, update):
+    """Dispatcher middleware that creates the Update_context before any handler runs"""
+    if update.message is not None and update.message.from_user is not None:
+        context_for(update)
+
+
 import time
 
 
@@ -86,31 +140,40 @@ def check_env_vars_all_loaded() -> Tuple[bool, str]:
     return (True, var)
 
 
-# TODO:move this logic elsewhere and handle singleton connection in
-# different way
-while conn is None:
-    try:
-        host = os.environ.get("POSTGRES_HOSTNAME")
-        database = os.environ.get("POSTGRES_DB")
-        user = os.environ.get("POSTGRES_USER")
-        password = os.environ.get("POSTGRES_PASS")
-        conn = psycopg2.connect(
-            host=host,
-            database=database,
-            user=user,
-            password=password)
-    except psycopg2.OperationalError as oe:
-        print(oe)
-        time.sleep(1)
-
+conn = connect_to_postgres()
 cursor = conn.cursor()
 
-
-def reply(bot: tg.Bot, update: tg.Update):
+# telegram_message text is written on its own connection off the vote path
+archive_max_text_length = os.environ.get('ARCHIVE_TEXT_MAX_LENGTH')
+archiver = Message_archiver(
+    connect_to_postgres(),
+    text_mode=os.environ.get('ARCHIVE_TEXT_MODE') or 'full',
+    max_text_length=int(archive_max_text_length) if archive_max_text_length else 200)
+
+# leaderboards and known users/chats, restored from the last snapshot if it is still valid
+snapshot_file = os.environ.get('SNAPSHOT_FILE')
+hot_state = load_hot_state(snapshot_file, get_snapshot_watermark(conn))
+
+# update_ids whose votes were recorded, the newest of them are kept in memory
+PROCESSED_UPDATES_WINDOW = 10000
+delete_old_processed_updates(7, conn)
+processed_update_ids = get_recent_processed_update_ids(PROCESSED_UPDATES_WINDOW, conn)
+recent_updates = Recent_updates(
+    PROCESSED_UPDATES_WINDOW, reversed(processed_update_ids))
+
+# votes over these rates are dropped before touching the database
+vote_detector = Vote_velocity_detector(
+    window=float(os.environ.get('VOTE_WINDOW_SECONDS') or 60),
+    max_votes_per_voter=int(os.environ.get('MAX_VOTES_PER_VOTER') or 10),
+    max_votes_per_target=int(os.environ.get('MAX_VOTES_PER_TARGET') or 20))
+
+
+@with_update_context
+def reply(bot: tg.Bot, update: tg.Update, ctx: Update_context):
     reply_user = user_from_tg_user(update.message.reply_to_message.from_user)
-    replying_user = user_from_tg_user(update.message.from_user)
-    chat_id = str(update.message.chat_id)
-    chat = Telegram_chat(chat_id, update.message.chat.title)
+    replying_user = ctx.user
+    chat = ctx.chat
+    chat_id = chat.chat_id
     original_message = Telegram_message(
         update.message.reply_to_message.message_id,
         chat.chat_id,
@@ -136,31 +199,56 @@ def reply(bot: tg.Bot, update: tg.Update):
                 " Who are you to +1 yourself?",
                 " Beware the Jabberwocky",
                 " Have a 🍪!",
-                " You must give praise. May he 🍔melt🍔! "
-                " Nigga, u for real??" 
-                " Me not appreciate that!!]
+                " You must give praise. May he 🍔melt🍔! ",
+                " Nigga, u for real??",
+                " Me not appreciate that!!"]
             response = random.choice(witty_responses)
             message = f"{replying_user.first_name}{response}"
             bot.send_message(chat_id=chat_id, text=message)
         else:  # user +1 someone else
-            user_reply_to_message(
-                replying_user,
-                reply_user,
-                chat,
-                original_message,
-                reply_message,
-                1,
-                conn)
-            logger.debug("user replying other user")
-            logger.debug(replying_user)
-            logger.debug(reply_user)
+            cast_vote(ctx, reply_user, original_message, reply_message, 1)
     # user -1 someone else
     elif re.match("^([\-mM][1-9][0-9]*|[Dd]{2}).*", reply_text):
-        user_reply_to_message(replying_user, reply_user,
-                              chat, original_message, reply_message, -1, conn)
-        logger.debug("user replying other user")
-        logger.debug(replying_user)
-        logger.debug(reply_user)
+        cast_vote(ctx, reply_user, original_message, reply_message, -1)
+
+
+def cast_vote(
+        ctx: Update_context,
+        receiver: User,
+        original_message: Telegram_message,
+        reply_message: Telegram_message,
+        respekt: int):
+    """Saves a vote unless the voter or receiver is voting too fast"""
+    voter = ctx.user
+    chat = ctx.chat
+    if not vote_detector.allow_vote(voter.id, receiver.id, chat.chat_id):
+        logger.info(f"Throttled vote by {voter.id} for {receiver.id} in chat {chat.chat_id}")
+        return
+    # hot_state.lock is held from before the vote commits until the leaderboard is
+    # invalidated, so neither a snapshot nor /respekt can pair the new vote with
+    # the leaderboard from before it
+    with hot_state.lock:
+        hot_state.invalidate_leaderboard(chat.chat_id)
+        user_reply_to_message(voter, receiver, chat, original_message,
+                              reply_message, respekt, conn,
+                              archive=archiver.archive, update_id=ctx.update_id,
+                              user_saved=ctx.user_saved or hot_state.is_user_known(voter),
+                              reply_to_user_saved=hot_state.is_user_known(receiver),
+                              chat_saved=ctx.chat_saved or hot_state.is_chat_known(chat.chat_id))
+        vote_recorded(chat, voter, receiver)
+    ctx.user_saved = True
+    ctx.chat_saved = True
+    logger.debug("user replying other user")
+    logger.debug(voter)
+    logger.debug(receiver)
+
+
+def vote_recorded(chat: Telegram_chat, voter: User, receiver: User):
+    """Keeps hot_state in line with a vote user_reply_to_message saved"""
+    hot_state.invalidate_leaderboard(chat.chat_id)
+    hot_state.add_chat(chat.chat_id)
+    hot_state.add_user(voter)
+    hot_state.add_user(receiver)
 
 
 def start(bot, update):
@@ -178,18 +266,9 @@ def show_version(bot, update, args):
 
 
 @types
-def show_user_stats(bot, update, args):
-    # TODO: remove this boiler plate code somehow
-    # without this if this is the first command run alone with the bot it will
-    # fail due to psycopg2.IntegrityError: insert or update on table
-    # "command_used" violates foreign key constraint
-    # "command_used_chat_id_fkey"
-    chat = Telegram_chat(str(update.message.chat_id),
-                         update.message.chat.title)
-    save_or_create_chat(chat, conn)
-
-    user_id = update.message.from_user.id
-    chat_id = str(update.message.chat_id)
+@with_update_context
+def show_user_stats(bot, update, ctx, args):
+    chat_id = ctx.chat.chat_id
     if len(args) != 1:
         bot.send_message(
             chat_id=update.message.chat_id,
@@ -199,10 +278,7 @@ def show_user_stats(bot, update, args):
     if username[0] == "@":
         username = username[1:]
 
-    use_command(
-        'userinfo', user_from_tg_user(
-            update.message.from_user), str(
-            update.message.chat_id), arguments=username)
+    use_command('userinfo', ctx, arguments=username)
 
     message = None
     try:
@@ -226,26 +302,33 @@ def show_user_stats(bot, update, args):
 # TODO: replace this with an annotation maybe?
 
 
-def use_command(command: str, user: User, chat_id: str, arguments=""):
-    create_chat_if_not_exists(chat_id, conn)
-    save_or_create_user(user, conn)
+def use_command(command: str, ctx: Update_context, arguments=""):
+    # command_used references the chat and user so they have to be saved first
+    if not hot_state.is_chat_known(ctx.chat.chat_id):
+        ctx.ensure_chat_saved(conn)
+        hot_state.add_chat(ctx.chat.chat_id)
+    if not hot_state.is_user_known(ctx.user):
+        ctx.ensure_user_saved(conn)
+        hot_state.add_user(ctx.user)
     insertcmd = """INSERT INTO command_used (command,arguments,user_id,chat_id) VALUES (%s,%s,%s,%s)"""
     with conn:
         with conn.cursor() as crs:
-            crs.execute(insertcmd, [command, arguments, user.id, chat_id])
+            crs.execute(insertcmd, [command, arguments, ctx.user.id, ctx.chat.chat_id])
 
 
 @types
-def show_respekt(bot, update, args):
-    use_command(
-        'showrespekt', user_from_tg_user(
-            update.message.from_user), str(
-            update.message.chat_id))
-    logger.debug("Chat id: " + str(update.message.chat_id))
+@with_update_context
+def show_respekt(bot, update, ctx, args):
+    use_command('showrespekt', ctx)
+    logger.debug("Chat id: " + ctx.chat.chat_id)
 
     # returns username, first_name, karma
-    rows: List[Tuple[str, str, int]] = get_respekt_for_users_in_chat(
-        str(update.message.chat_id), conn)
+    # locked so a vote can't commit between reading and caching the leaderboard
+    with hot_state.lock:
+        rows: List[Tuple[str, str, int]] = hot_state.get_leaderboard(ctx.chat.chat_id)
+        if rows is None:
+            rows = get_respekt_for_users_in_chat(ctx.chat.chat_id, conn)
+            hot_state.set_leaderboard(ctx.chat.chat_id, rows)
     rows.sort(key=lambda user: user[2], reverse=True)
     # use firstname if username not set
 
@@ -278,13 +361,11 @@ def show_respekt(bot, update, args):
 
 
 @types
-def show_chat_info(bot, update, args):
-    use_command(
-        'chatinfo', user_from_tg_user(
-            update.message.from_user), str(
-            update.message.chat_id))
-    chat_id = str(update.message.chat_id)
-    title = update.message.chat.title
+@with_update_context
+def show_chat_info(bot, update, ctx, args):
+    use_command('chatinfo', ctx)
+    chat_id = ctx.chat.chat_id
+    title = ctx.chat.chat_name
     if title is None:
         title = "No Title"
     result = get_chat_info(chat_id, conn)
@@ -299,6 +380,21 @@ def am_I_admin(bot, update, args):
     bot.send_message(chat_id=update.message.chat_id, text=message)
 
 
+@restricted
+def show_vote_rates(bot, update, args):
+    """Lists voters and receivers whose votes were throttled"""
+    rows = []
+    for (kind, user_id, chat_id, in_window, times) in vote_detector.flagged_rates()[:20]:
+        rows.append(f"{kind} {user_id} in {chat_id}: "
+                    f"{in_window} votes in window, throttled {times} times")
+    if rows:
+        message = (f"Throttled voters and receivers, votes counted over "
+                   f"{vote_detector.window:.0f}s:\n" + "\n".join(rows))
+    else:
+        message = "No votes have been throttled"
+    bot.send_message(chat_id=update.message.chat_id, text=message)
+
+
 def show_respekt_personally(bot, update, args):
     # TODO:check if this is a 1 on 1 message handler
     # offer choice to user of which chat they want to see the karma totals of
@@ -318,18 +414,15 @@ def unknown(bot, update):
                      text="Sorry, I didn't understand that command.")
 
 
-def main():
-    """Start the bot """
-    (is_loaded, var) = check_env_vars_all_loaded()
-    if not is_loaded:
-        logger.info("Env vars not set that are required: " + str(var))
-        sys.exit(1)
-
-    # Setup bot token from environment variables
-    bot_token = os.environ.get('BOT_TOKEN')
-
-    updater = Updater(token=bot_token)
-    dispatcher = updater.dispatcher
+def add_handlers(dispatcher):
+    """Registers the bot's handlers on dispatcher.
+    Shared by main() and replay.py so replays exercise the same handlers"""
+    dispatcher.add_handler(
+        TypeHandler(tg.Update, reject_duplicate_update),
+        group=DUPLICATE_UPDATES_GROUP)
+    dispatcher.add_handler(
+        TypeHandler(tg.Update, attach_update_context),
+        group=UPDATE_CONTEXT_GROUP)
 
     start_handler = CommandHandler('start', start)
     dispatcher.add_handler(start_handler)
@@ -337,8 +430,9 @@ def main():
     reply_handler = MessageHandler(Filters.reply, reply)
     dispatcher.add_handler(reply_handler)
 
-    showkarma_handler = CommandHandler('showkarma', show_karma, pass_args=True)
-    dispatcher.add_handler(showkarma_handler)
+    showrespekt_handler = CommandHandler(
+        'showrespekt', show_respekt, pass_args=True)
+    dispatcher.add_handler(showrespekt_handler)
 
     show_user_handler = CommandHandler(
         'userinfo', show_user_stats, pass_args=True)
@@ -351,6 +445,10 @@ def main():
     am_I_admin_handler = CommandHandler('amiadmin', am_I_admin, pass_args=True)
     dispatcher.add_handler(am_I_admin_handler)
 
+    vote_rates_handler = CommandHandler(
+        'voterates', show_vote_rates, pass_args=True)
+    dispatcher.add_handler(vote_rates_handler)
+
     showversion_handler = CommandHandler(
         'version', show_version, pass_args=True)
     dispatcher.add_handler(showversion_handler)
@@ -360,7 +458,135 @@ def main():
     unknown_handler = MessageHandler(Filters.command, unknown)
     dispatcher.add_handler(unknown_handler)
 
-    updater.start_polling()
+    dispatcher.add_handler(
+        TypeHandler(tg.Update, mark_update_processed),
+        group=PROCESSED_UPDATES_GROUP)
+
+
+# seconds a getUpdates long poll waits, shutdown has to wait out the one in progress
+POLLING_TIMEOUT = 5
+
+
+def save_pending_updates(updates: List[tg.Update], path: str):
+    """Writes updates that were fetched but not finished so the next start processes them.
+    Telegram won't send them again, the offset confirming them was already sent"""
+    writer = Update_recorder(path)
+    for update in updates:
+        writer.record(None, update)
+    writer.close()
+
+
+def process_pending_updates(dispatcher, path: str):
+    """Processes the updates save_pending_updates left behind, then removes the file.
+    Votes in them that were already recorded are skipped through processed_update"""
+    if not os.path.exists(path):
+        return
+    pending = list(read_updates(path, dispatcher.bot))
+    logger.info(f"Processing {len(pending)} updates left over from the last shutdown")
+    for update in pending:
+        dispatcher.process_update(update)
+    os.remove(path)
+
+
+def shutdown(updater: Updater, inflight: Inflight_updates, deadline: float,
+             recorder=None, snapshot_conn=None, pending_file=None) -> bool:
+    """Stops polling, lets the dispatcher finish the updates it already fetched and
+    flushes the message archiver, taking deadline seconds at most.
+    Updates not finished by then are written to pending_file when it is given, otherwise they are lost.
+    Returns False if updates were still being processed when the deadline ran out"""
+    started = time.monotonic()
+
+    def remaining():
+        return max(0.0, deadline - (time.monotonic() - started))
+
+    finished_before = inflight.finished
+    dispatcher = updater.dispatcher
+    # the polling thread stops after its current long poll and ignores what that poll returns,
+    # the dispatcher keeps working through the update queue meanwhile
+    updater.running = False
+    while remaining() > 0 and (not dispatcher.update_queue.empty() or inflight.inflight > 0):
+        time.sleep(min(remaining(), 0.05))
+    # the dispatcher only stops once its queue is empty, then the polling thread is joined
+    stopper = threading.Thread(target=updater.stop, name='updater_stop', daemon=True)
+    stopper.start()
+    stopper.join(remaining())
+    finished = not stopper.is_alive()
+    if not finished:
+        logger.warning("Updater did not stop before the shutdown deadline")
+    drained = inflight.finished - finished_before
+    # the one being processed may be done twice, votes are only recorded once
+    unfinished = inflight.processing_updates()
+    while True:
+        try:
+            unfinished.append(dispatcher.update_queue.get_nowait())
+        except queue.Empty:
+            break
+    unfinished = [update for update in unfinished if isinstance(update, tg.Update)]
+    if unfinished and pending_file:
+        save_pending_updates(unfinished, pending_file)
+
+    archiver.close(remaining())
+    if recorder is not None:
+        recorder.close()
+    if snapshot_conn is not None:
+        hot_state.save(snapshot_file, get_snapshot_watermark(snapshot_conn))
+        snapshot_conn.close()
+    if finished:
+        cursor.close()
+        conn.close()
+    logger.info(f"Shut down in {time.monotonic() - started:.1f}s: "
+                f"{drained} updates drained, {len(unfinished)} "
+                f"{'saved to ' + pending_file if pending_file else 'lost'}, "
+                f"{archiver.pending()} messages not archived")
+    return finished
+
+
+def main():
+    """Start the bot """
+    (is_loaded, var) = check_env_vars_all_loaded()
+    if not is_loaded:
+        logger.info("Env vars not set that are required: " + str(var))
+        sys.exit(1)
+
+    # Setup bot token from environment variables
+    bot_token = os.environ.get('BOT_TOKEN')
+
+    updater = Updater(token=bot_token)
+    dispatcher = updater.dispatcher
+
+    # record raw updates so they can be replayed with replay.py
+    recorder = None
+    record_file = os.environ.get('RECORD_UPDATES_FILE')
+    if record_file:
+        logger.info("Recording updates to: " + record_file)
+        recorder = Update_recorder(record_file)
+        dispatcher.add_handler(
+            TypeHandler(tg.Update, recorder.record),
+            group=RECORD_UPDATES_GROUP)
+
+    add_handlers(dispatcher)
+    inflight = Inflight_updates()
+    dispatcher.process_update = inflight.track(dispatcher.process_update)
+
+    snapshot_conn = None
+    if snapshot_file:
+        snapshot_conn = connect_to_postgres()
+        interval = int(os.environ.get('SNAPSHOT_INTERVAL') or 60)
+        updater.job_queue.run_repeating(
+            save_snapshot, interval, context=snapshot_conn)
+
+    # updates the last run fetched but didn't finish before its shutdown deadline
+    pending_file = os.environ.get('PENDING_UPDATES_FILE')
+    if pending_file:
+        process_pending_updates(dispatcher, pending_file)
+
+    # skip updates the last run already processed
+    last_update_id = max(
+        hot_state.last_update_id, max(processed_update_ids, default=0))
+    if last_update_id:
+        updater.last_update_id = last_update_id + 1
+
+    updater.start_polling(timeout=POLLING_TIMEOUT)
 
     cursor.execute("SELECT * FROM pg_catalog.pg_tables;")
     many = cursor.fetchall()
@@ -368,10 +594,20 @@ def main():
         map(lambda x: x[1], filter(lambda x: x[0] == 'public', many)))
     logger.info("public_tables: " + str(public_tables))
 
-    updater.idle()
-
-    cursor.close()
-    conn.close()
+    # replaces updater.idle(), which stops the updater with no deadline
+    stop_requested = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+        signal.signal(sig, lambda signum, frame: stop_requested.set())
+    while not stop_requested.wait(1):
+        pass
+    logger.info("Stop requested, draining updates")
+    finished = shutdown(updater, inflight,
+                        float(os.environ.get('SHUTDOWN_DEADLINE') or 20),
+                        recorder=recorder, snapshot_conn=snapshot_conn,
+                        pending_file=pending_file)
+    if not finished:
+        # the dispatcher and polling threads aren't daemons and would keep the process alive
+        os._exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+from threading import RLock
+from typing import Dict, List, Optional, Tuple
+
+from models import User
+
+logger = logging.getLogger(__name__)
+
+# first bytes of a snapshot file, bump the digit when the layout changes
+SNAPSHOT_MAGIC = b'RSPKSNP2'
+
+
+class Hot_state(object):
+    """
+    State the bot keeps in memory between updates: per chat leaderboards,
+    the users and chats known to be saved and the last processed update_id.
+    It is snapshotted to disk so a restart doesn't start cold
+    """
+    leaderboards: Dict[str, List[Tuple[str, str, int]]]
+    known_chat_ids: set
+    known_users: Dict[int, Tuple[str, str, str]]
+    last_update_id: int
+
+    def __init__(self):
+        self.leaderboards = {}
+        self.known_chat_ids = set()
+        self.known_users = {}
+        self.last_update_id = 0
+        # reentrant so callers can hold it across a database write and the
+        # updates to the state that go with it
+        self.lock = RLock()
+
+    def get_leaderboard(self, chat_id: str) -> Optional[List[Tuple[str, str, int]]]:
+        with self.lock:
+            rows = self.leaderboards.get(chat_id)
+            return list(rows) if rows is not None else None
+
+    def set_leaderboard(self, chat_id: str, rows: List[Tuple[str, str, int]]):
+        with self.lock:
+            self.leaderboards[chat_id] = list(rows)
+
+    def invalidate_leaderboard(self, chat_id: str):
+        with self.lock:
+            self.leaderboards.pop(chat_id, None)
+
+    def is_chat_known(self, chat_id: str) -> bool:
+        return chat_id in self.known_chat_ids
+
+    def add_chat(self, chat_id: str):
+        with self.lock:
+            self.known_chat_ids.add(chat_id)
+
+    def is_user_known(self, user: User) -> bool:
+        """True if user was saved with the same names it has now"""
+        return self.known_users.get(user.id) == (
+            user.username, user.first_name, user.last_name)
+
+    def add_user(self, user: User):
+        """Remembers user as saved. If it was saved under other names before, the
+        leaderboards showing the old names are dropped so they are read again"""
+        names = (user.username, user.first_name, user.last_name)
+        with self.lock:
+            old_names = self.known_users.get(user.id)
+            if old_names is not None and old_names != names:
+                # leaderboard rows are (username, first_name, respekt)
+                self.leaderboards = {
+                    chat_id: rows for (chat_id, rows) in self.leaderboards.items()
+                    if not any(tuple(row[:2]) == old_names[:2] for row in rows)}
+            self.known_users[user.id] = names
+
+    def processed_update(self, update_id: int):
+        with self.lock:
+            if update_id > self.last_update_id:
+                self.last_update_id = update_id
+
+    def save(self, path: str, watermark: int):
+        """Atomically writes the state to path.
+        watermark must be read from the database before calling so the snapshot
+        is never older than the watermark it is stored with"""
+        with self.lock:
+            # json rather than pickle, the file sits on a shared volume and
+            # loading a tampered pickle would run arbitrary code
+            payload = json.dumps({
+                'watermark': watermark,
+                'leaderboards': self.leaderboards,
+                'known_chat_ids': sorted(self.known_chat_ids),
+                'known_users': {str(user_id): names for (user_id, names) in self.known_users.items()},
+                'last_update_id': self.last_update_id,
+            }, separators=(',', ':')).encode('utf-8')
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(SNAPSHOT_MAGIC)
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+def load_hot_state(path: Optional[str], watermark: int) -> Hot_state:
+    """Reads the snapshot at path and checks it against the database watermark.
+
+    The leaderboards and the known users and chats are only reused when no vote happened
+    since the snapshot. If the watermark moved, or is 0 so a recreated database can't be
+    told apart, they are dropped and the users and chats get saved again on first use.
+    If the database is behind the snapshot (e.g. it was restored from a backup) the whole
+    snapshot is ignored. An empty Hot_state is returned when there is no usable snapshot
+    """
+    state = Hot_state()
+    if not path or not os.path.exists(path):
+        return state
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            logger.warning(f"Ignoring snapshot {path} with unknown format")
+            return state
+        snapshot = json.loads(data[len(SNAPSHOT_MAGIC):].decode('utf-8'))
+        snapshot_watermark = int(snapshot['watermark'])
+        last_update_id = int(snapshot['last_update_id'])
+        leaderboards = {
+            str(chat_id): [(username, first_name, int(respekt))
+                           for (username, first_name, respekt) in rows]
+            for (chat_id, rows) in snapshot['leaderboards'].items()}
+        known_chat_ids = set(str(chat_id) for chat_id in snapshot['known_chat_ids'])
+        known_users = {
+            int(user_id): (username, first_name, last_name)
+            for (user_id, (username, first_name, last_name)) in snapshot['known_users'].items()}
+    except (OSError, ValueError, KeyError, TypeError, AttributeError) as e:
+        logger.warning(f"Ignoring unreadable snapshot {path}: {e}")
+        return state
+
+    if snapshot_watermark > watermark:
+        logger.warning(
+            f"Ignoring snapshot {path}, it is ahead of the database "
+            f"({snapshot_watermark} > {watermark})")
+        return state
+    if snapshot_watermark == watermark and watermark > 0:
+        state.leaderboards = leaderboards
+        state.known_chat_ids = known_chat_ids
+        state.known_users = known_users
+    state.last_update_id = last_update_id
+    logger.info(
+        f"Loaded snapshot {path}: {len(state.leaderboards)} leaderboards, "
+        f"{len(state.known_chat_ids)} chats, {len(state.known_users)} users, "
+        f"last update {state.last_update_id}")
+    return state
@@ -0,0 +1,40 @@
+from functools import wraps
+from threading import Condition
+from typing import List, Optional
+
+
+class Inflight_updates(object):
+    """Tracks the updates the dispatcher is processing so shutdown can wait for them"""
+
+    def __init__(self):
+        self.condition = Condition()
+        self.inflight = 0
+        self.finished = 0
+        self.processing: List = []
+
+    def track(self, process_update):
+        """Wraps Dispatcher.process_update to count updates in and out"""
+        @wraps(process_update)
+        def tracked(update):
+            with self.condition:
+                self.inflight = self.inflight + 1
+                self.processing.append(update)
+            try:
+                return process_update(update)
+            finally:
+                with self.condition:
+                    self.inflight = self.inflight - 1
+                    self.processing.remove(update)
+                    self.finished = self.finished + 1
+                    self.condition.notify_all()
+        return tracked
+
+    def processing_updates(self) -> List:
+        """The updates being processed right now, oldest first"""
+        with self.condition:
+            return list(self.processing)
+
+    def wait_idle(self, timeout: Optional[float]) -> bool:
+        """Blocks until no update is being processed, False if timeout ran out first"""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.inflight == 0, timeout)
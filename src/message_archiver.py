@@ -0,0 +1,130 @@
+import logging
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+from typing import List, Optional
+
+from psycopg2.extras import execute_values
+
+from models import Telegram_message
+
+logger = logging.getLogger(__name__)
+
+TEXT_MODES = ('full', 'truncate', 'compress', 'none')
+
+# sentinel put on the queue by close() to stop the writer thread
+_STOP = object()
+
+
+class Message_archiver(object):
+    """Saves telegram messages to telegram_message on a background thread.
+
+    Messages are written in batches on their own connection so votes don't wait on
+    archiving. Ids of recently archived messages are kept in an LRU so a message
+    replied to many times is only written once.
+
+    text_mode decides how message_text is stored:
+    full keeps it as is, truncate keeps the first max_text_length characters,
+    compress stores it zlib compressed in message_text_compressed and none drops it.
+    """
+
+    def __init__(
+            self,
+            conn,
+            text_mode: str = 'full',
+            max_text_length: int = 200,
+            batch_size: int = 100,
+            flush_interval: float = 1.0,
+            known_capacity: int = 10000):
+        if text_mode not in TEXT_MODES:
+            raise ValueError(f"text_mode must be one of {TEXT_MODES}, got {text_mode}")
+        self.conn = conn
+        self.text_mode = text_mode
+        self.max_text_length = max_text_length
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.known_capacity = known_capacity
+        self.known_message_ids = OrderedDict()
+        self.known_lock = threading.Lock()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+            target=self._run, name='message_archiver', daemon=True)
+        self.thread.start()
+
+    def archive(self, message: Telegram_message):
+        """Queues message to be saved unless it was archived recently"""
+        with self.known_lock:
+            if message.message_id in self.known_message_ids:
+                self.known_message_ids.move_to_end(message.message_id)
+                return
+            self.known_message_ids[message.message_id] = True
+            if len(self.known_message_ids) > self.known_capacity:
+                self.known_message_ids.popitem(last=False)
+        self.queue.put(message)
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def close(self, timeout: Optional[float] = None):
+        """Writes everything still queued then stops the writer thread"""
+        self.queue.put(_STOP)
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            logger.warning(
+                f"Message archiver did not finish, {self.pending()} messages not archived")
+        else:
+            self.conn.close()
+
+    def _stored_text(self, text: Optional[str]):
+        """Returns (message_text, message_text_compressed) for text_mode"""
+        if text is None or self.text_mode == 'none':
+            return (None, None)
+        if self.text_mode == 'truncate':
+            return (text[:self.max_text_length], None)
+        if self.text_mode == 'compress':
+            return (None, zlib.compress(text.encode('utf-8')))
+        return (text, None)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch: List[Telegram_message] = []
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            while item is not _STOP:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stopping = item is _STOP
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch: List[Telegram_message]):
+        insert_messages = """INSERT INTO telegram_message
+        (message_id, chat_id, author_user_id, message_text, message_text_compressed)
+        VALUES %s
+        ON CONFLICT (message_id) DO UPDATE
+        SET message_text = EXCLUDED.message_text,
+        message_text_compressed = EXCLUDED.message_text_compressed"""
+        rows = []
+        for message in batch:
+            (text, compressed) = self._stored_text(message.message_text)
+            rows.append((message.message_id, message.chat_id,
+                         message.author_user_id, text, compressed))
+        try:
+            with self.conn:
+                with self.conn.cursor() as crs:
+                    execute_values(crs, insert_messages, rows)
+        except Exception:
+            logger.exception(f"Failed to archive {len(batch)} messages")
+            # forget them so the next reply to one of them retries
+            with self.known_lock:
+                for message in batch:
+                    self.known_message_ids.pop(message.message_id, None)
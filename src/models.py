@@ -86,7 +86,7 @@ class User_in_chat(object):
     def __init__(self, user_id: int, chat_id: int, respekt: int):
         self.user_id = user_id
         self.chat_id = chat_id
-        self.karma = karma
+        self.respekt = respekt
 
 
 class Telegram_chat(object):
@@ -1,6 +1,30 @@
 from models import User, User_in_chat, Telegram_chat, Telegram_message
-from typing import Optional, Tuple, List, Dict
+from typing import Callable, Optional, Tuple, List, Dict
 import logging
+import os
+import time
+import psycopg2
+
+
+def connect_to_postgres():
+    """Connects with the POSTGRES_* environment variables,
+    retrying until postgres accepts the connection"""
+    connection = None
+    while connection is None:
+        try:
+            host = os.environ.get("POSTGRES_HOSTNAME")
+            database = os.environ.get("POSTGRES_DB")
+            user = os.environ.get("POSTGRES_USER")
+            password = os.environ.get("POSTGRES_PASS")
+            connection = psycopg2.connect(
+                host=host,
+                database=database,
+                user=user,
+                password=password)
+        except psycopg2.OperationalError as oe:
+            print(oe)
+            time.sleep(1)
+    return connection
 
 
 class UserNotFound(Exception):
@@ -26,6 +50,8 @@ def get_user_by_username(username: str, conn) -> User:
             selectcmd = "SELECT user_id, username, first_name, last_name from telegram_user tu where tu.username=%s"
             crs.execute(selectcmd, [username])
             res = crs.fetchone()
+            if res is None:
+                return None
             return User(res[0], res[1], res[2], res[3])
 
 # TODO: pass in user_id
@@ -37,7 +63,7 @@ def get_user_stats(username: str, chat_id: str, conn) -> Dict:
     user = get_user_by_username(username, conn)
     if user is None:
         raise UserNotFound()
-    user_has_reacts = did_user_react_to_messages(username, conn)
+    user_has_reacts = did_user_react_to_messages(user.id, conn)
     respekt = get_respekt_for_user_in_chat(username, chat_id, conn)
     if respekt is None:
         respekt = 0
@@ -46,18 +72,16 @@ def get_user_stats(username: str, chat_id: str, conn) -> Dict:
     if not user_has_reacts:
         output_dict = {
             'username': username,
-            'Respekt': respekt,
+            'respekt': respekt,
             'upvotes_given': 0,
             'downvotes_given': 0,
             'total_votes_given': 0,
             'net_respekt_given': 0}
     else:
         # how many reacts given out by user
-        how_many_user_reacted_to_stats = """select react_score, count(react_score)from
-            (select username, message_id, react_score, react_message_id  from telegram_user tu
-            left join user_reacted_to_message urtm on urtm.user_id=tu.user_id
-            where tu.username = %s) as sub left join telegram_message tm on  tm.message_id= sub.message_id
-            where tm.chat_id=%s group by react_score;"""
+        how_many_user_reacted_to_stats = """select urtm.react_score, count(*) from user_reacted_to_message urtm
+            join telegram_message tm on tm.message_id = urtm.message_id
+            where urtm.user_id = %s and tm.chat_id = %s group by urtm.react_score;"""
         # TODO: implement how many reacts recieved by user
         how_many_reacted_to_user_stats = """"""
         negative_respekt_given = 0
@@ -67,20 +91,19 @@ def get_user_stats(username: str, chat_id: str, conn) -> Dict:
             with conn.cursor() as crs:
                 crs.execute(
                     how_many_user_reacted_to_stats, [
-                        username, chat_id])
+                        user.id, chat_id])
                 rows = crs.fetchall()
                 # there are only two rows
                 for row in rows:
                     if row[0] == -1:
-                        negative_karma_given = int(row[1])
+                        negative_respekt_given = int(row[1])
                     if row[0] == 1:
-                        positive_karma_given = int(row[1])
-                result = crs.fetchone()
+                        positive_respekt_given = int(row[1])
 
         # TODO: make this output type a class instead to bundle this info
         output_dict = {
             'username': username,
-            'Respekt': respekt,
+            'respekt': respekt,
             'upvotes_given': positive_respekt_given,
             'downvotes_given': negative_respekt_given,
             'total_votes_given': positive_respekt_given + negative_respekt_given,
@@ -89,13 +112,11 @@ def get_user_stats(username: str, chat_id: str, conn) -> Dict:
 
 
 def get_chat_info(chat_id: str, conn) -> Dict:
-    count_reacts_cmd = """select count(tm.message_id) from user_reacted_to_message urtm
-left join telegram_message tm ON tm.message_id = urtm.message_id
+    count_reacts_cmd = """select count(*) from telegram_message tm
+join user_reacted_to_message urtm ON urtm.message_id = tm.message_id
 where tm.chat_id=%s"""
     select_user_with_respekt_count = """
-    select count(*) from telegram_chat tc
-    left join user_in_chat uic on uic.chat_id = tc.chat_id
-    where tc.chat_id=%s
+    select count(*) from user_in_chat uic where uic.chat_id=%s
     """
     with conn:
         with conn.cursor() as crs:
@@ -119,15 +140,13 @@ where tm.chat_id=%s"""
                     'user_with_respekt_count': user_with_respekt_count}
 
 
-# TODO: use user_id instead of username
-def did_user_react_to_messages(username: str, conn) -> bool:
-    select_user_replies = """select username, message_id, react_score, react_message_id  from telegram_user tu
-            left join user_reacted_to_message urtm on urtm.user_id=tu.user_id
-            where tu.username = %s"""
+def did_user_react_to_messages(user_id: int, conn) -> bool:
+    select_user_replies = """select 1 from user_reacted_to_message urtm
+            where urtm.user_id = %s limit 1"""
     reacted_messages_result = None
     with conn:
         with conn.cursor() as crs:
-            crs.execute(select_user_replies, [username])
+            crs.execute(select_user_replies, [user_id])
             reacted_messages_result = crs.fetchone()
             return reacted_messages_result is not None
 # TODO: user user_id
@@ -199,16 +218,9 @@ def save_or_create_user_in_chat(
         change_respekt=0) -> User_in_chat:
     with conn:
         with conn.cursor() as crs:  # I would love type hints here but psycopg2.cursor isn't a defined class
-            # TODO: instead of select first, do insert and then trap exception
-            # if primary key exists
-            selectcmd = "SELECT user_id, chat_id, karma FROM user_in_chat uic where uic.user_id=%s AND uic.chat_id=%s"
-            crs.execute(selectcmd, [user.id, chat_id, ])
-
-            result = crs.fetchone()
-
             insertcmd_respekt = """INSERT into user_in_chat
                 (user_id, chat_id, respekt) VALUES (%s,%s,%s)
-                ON CONFLICT (user_id,chat_id) DO UPDATE SET respekt = user_in_chat.karma + %s
+                ON CONFLICT (user_id,chat_id) DO UPDATE SET respekt = user_in_chat.respekt + %s
                 RETURNING respekt
                 """
 
@@ -234,10 +246,23 @@ def user_reply_to_message(
         original_message: Telegram_message,
         reply_message: Telegram_message,
         respekt: int,
-        conn):
-    user: User = save_or_create_user(user, conn)
-    reply_to_user: User = save_or_create_user(reply_to_user, conn)
-    if not does_chat_exist(chat.chat_id, conn):
+        conn,
+        archive: Optional[Callable[[Telegram_message], None]] = None,
+        update_id: Optional[int] = None,
+        user_saved: bool = False,
+        reply_to_user_saved: bool = False,
+        chat_saved: bool = False):
+    """Records user reacting to original_message with respekt.
+    When archive is passed the message texts are handed to it to be saved later,
+    only a row without text is written for original_message since the react references it.
+    When update_id is passed it is logged in processed_update with the vote
+    and the vote is skipped if that update was already processed.
+    The *_saved flags skip saving users or the chat the caller knows are saved already"""
+    if not user_saved:
+        user = save_or_create_user(user, conn)
+    if not reply_to_user_saved:
+        reply_to_user = save_or_create_user(reply_to_user, conn)
+    if not chat_saved and not does_chat_exist(chat.chat_id, conn):
         save_or_create_chat(chat, conn)
 
     uic: User_in_chat = save_or_create_user_in_chat(user, chat.chat_id, conn)
@@ -250,6 +275,11 @@ def user_reply_to_message(
     ON CONFLICT (message_id) DO UPDATE
     SET message_text = EXCLUDED.message_text;
     """
+    insert_message_without_text = """INSERT INTO telegram_message
+    (message_id,chat_id, author_user_id)
+    VALUES (%s,%s,%s)
+    ON CONFLICT (message_id) DO NOTHING;
+    """
     selecturtm = """SELECT * from user_reacted_to_message urtm where urtm.user_id=%s and urtm.message_id=%s and urtm.react_message_id=%s"""
     inserturtm = """INSERT INTO user_reacted_to_message
     (user_id,message_id,react_score,react_message_id)
@@ -257,44 +287,63 @@ def user_reply_to_message(
 
     # TODO: manage this with a constraint rather than having to select
     selecturtmunique = """SELECT react_score from user_reacted_to_message urtm where urtm.user_id=%s and urtm.message_id=%s"""
-    # none if user hasn't reacted yet
-    user_previous_react = None
+    change_respekt = """UPDATE user_in_chat SET respekt = respekt + %s
+    WHERE user_id=%s AND chat_id=%s"""
+    insert_processed_update = """INSERT INTO processed_update (update_id) VALUES (%s)
+    ON CONFLICT (update_id) DO NOTHING
+    RETURNING update_id"""
+
+    # the update is marked processed in the same transaction as the vote
+    # so a re-delivered update can never apply the vote twice
     with conn:
         with conn.cursor() as crs:
+            if update_id is not None:
+                crs.execute(insert_processed_update, [update_id])
+                if crs.fetchone() is None:
+                    logging.info(f"update {update_id} already processed, vote ignored")
+                    return
+            # none if user hasn't reacted yet
+            user_previous_react = None
             args_select_urtm = [uic.user_id, original_message.message_id]
             crs.execute(selecturtmunique, args_select_urtm)
             result = crs.fetchone()
             if result is not None:
                 user_previous_react = result[0]
 
-    # TODO: add gaurd for karma == 1 or == -1 up higher
-    if user_previous_react is None or user_previous_react != respekt:
-        if(respekt == 1 or respekt == -1):
-            save_or_create_user_in_chat(
-                reply_to_user, chat.chat_id, conn, change_respekt=respekt)
-        else:
-            logging.info(
-                f"invalid respekt: {karma} passed to user_reply_to_message")
-        with conn:
-            with conn.cursor() as crs:
-                args_reply_message = [
-                    reply_message.message_id,
-                    chat.chat_id,
-                    uic.user_id,
-                    reply_message.message_text]
-                args_original_message = [
-                    original_message.message_id,
-                    chat.chat_id,
-                    original_message.author_user_id,
-                    original_message.message_text]
+            # TODO: add gaurd for karma == 1 or == -1 up higher
+            if user_previous_react is not None and user_previous_react == respekt:
+                return
+            if(respekt == 1 or respekt == -1):
+                crs.execute(change_respekt,
+                            [respekt, reply_to_uic.user_id, chat.chat_id])
+            else:
+                logging.info(
+                    f"invalid respekt: {respekt} passed to user_reply_to_message")
+            args_reply_message = [
+                reply_message.message_id,
+                chat.chat_id,
+                uic.user_id,
+                reply_message.message_text]
+            args_original_message = [
+                original_message.message_id,
+                chat.chat_id,
+                original_message.author_user_id,
+                original_message.message_text]
+            if archive is None:
                 crs.execute(insert_message, args_reply_message)
                 crs.execute(insert_message, args_original_message)
-                argsurtm = [
-                    uic.user_id,
-                    original_message.message_id,
-                    karma,
-                    reply_message.message_id]
-                crs.execute(inserturtm, argsurtm)
+            else:
+                crs.execute(insert_message_without_text,
+                            args_original_message[:3])
+            argsurtm = [
+                uic.user_id,
+                original_message.message_id,
+                respekt,
+                reply_message.message_id]
+            crs.execute(inserturtm, argsurtm)
+    if archive is not None:
+        archive(original_message)
+        archive(reply_message)
 
 
 def get_respekt_for_user_in_chat(
@@ -302,7 +351,7 @@ def get_respekt_for_user_in_chat(
         chat_id: str,
         conn) -> Optional[int]:
     cmd = """select respekt from telegram_user tu
-        LEFT JOIN user_in_chat uic ON uic.user_id=tu.user_id
+        JOIN user_in_chat uic ON uic.user_id=tu.user_id
         where tu.username=%s AND uic.chat_id=%s"""
     with conn:
         with conn.cursor() as crs:
@@ -317,8 +366,8 @@ def get_respekt_for_user_in_chat(
 
 def get_respekt_for_users_in_chat(
         chat_id: str, conn) -> List[Tuple[str, str, int]]:
-    cmd = """select username, first_name, respekt from telegram_user tu
-        LEFT JOIN user_in_chat uic ON uic.user_id=tu.user_id
+    cmd = """select username, first_name, respekt from user_in_chat uic
+        JOIN telegram_user tu ON tu.user_id=uic.user_id
         where uic.chat_id=%s;"""
     with conn:
         with conn.cursor() as crs:
@@ -328,21 +377,65 @@ def get_respekt_for_users_in_chat(
             return crs.fetchall()
 
 
-def get_message_responses_for_user_in_chat(user_id: int, chat_id: int, conn):
-    cmd = """    SELECT sub3.user_id, sub3.message_id, sub3.response_text AS message_text, urtm.react_score,
-        urtm.react_message_id, sub3.username AS responder_username, sub3.first_name AS responder_first_name,
-         sub3.last_name AS responder_last_name  FROM (
-        SELECT  sub2.user_id, tm.message_id, tm.message_text AS response_text,  uic_id ,
-            sub2.username, sub2.first_name, sub2.last_name FROM (
-            SELECT uic_id, sub.user_id, sub.karma, tu.username, tu.first_name, tu.last_name FROM (
-                SELECT id AS uic_id, a.user_id, chat_id, karma FROM (
-                    select * from user_in_chat uic where uic.user_id = %s AND uic.chat_id=%s
-                    ) as a
-            ) AS sub
-            LEFT JOIN telegram_user tu ON tu.user_id=sub.user_id) AS sub2
-        LEFT JOIN telegram_message tm ON uic_id=tm.author_user_in_chat_id) AS sub3
-    LEFT JOIN user_reacted_to_message urtm ON urtm.message_id = sub3.message_id;"""
+def get_message_responses_for_user_in_chat(user_id: int, chat_id: str, conn):
+    """Every react to messages user_id wrote in chat_id, with the user who reacted"""
+    cmd = """SELECT tm.author_user_id AS user_id, tm.message_id, tm.message_text, urtm.react_score,
+        urtm.react_message_id, tu.username AS responder_username, tu.first_name AS responder_first_name,
+        tu.last_name AS responder_last_name
+    FROM telegram_message tm
+    JOIN user_reacted_to_message urtm ON urtm.message_id = tm.message_id
+    LEFT JOIN telegram_user tu ON tu.user_id = urtm.user_id
+    WHERE tm.author_user_id = %s AND tm.chat_id = %s;"""
     with conn:
         with conn.cursor() as crs:
             crs.execute(cmd, [user_id, chat_id])
             return crs.fetchall()
+
+
+def get_user_in_chat_totals(conn) -> List[Tuple[str, int, int]]:
+    """Returns (chat_id, user_id, respekt) for every user_in_chat row.
+    Used by replay.py to compare the outcome of a replay"""
+    cmd = """select chat_id, user_id, respekt from user_in_chat
+        order by chat_id, user_id"""
+    with conn:
+        with conn.cursor() as crs:
+            crs.execute(cmd)
+            return crs.fetchall()
+
+
+def clear_all_tables(conn):
+    """Deletes every row the bot has written. Only used by replay.py --reset"""
+    cmd = """TRUNCATE user_reacted_to_message, telegram_message, command_used,
+        user_in_chat, telegram_chat, telegram_user, processed_update"""
+    with conn:
+        with conn.cursor() as crs:
+            crs.execute(cmd)
+
+
+def get_snapshot_watermark(conn) -> int:
+    """Id of the newest react. Every respekt change inserts a react,
+    so a cached leaderboard is current as long as this hasn't changed"""
+    cmd = """select coalesce(max(id), 0) from user_reacted_to_message"""
+    with conn:
+        with conn.cursor() as crs:
+            crs.execute(cmd)
+            return crs.fetchone()[0]
+
+
+def get_recent_processed_update_ids(limit: int, conn) -> List[int]:
+    """The newest update_ids in processed_update, newest first"""
+    cmd = """select update_id from processed_update
+        order by update_id desc limit %s"""
+    with conn:
+        with conn.cursor() as crs:
+            crs.execute(cmd, [limit])
+            return [row[0] for row in crs.fetchall()]
+
+
+def delete_old_processed_updates(days: int, conn):
+    """Telegram only re-delivers recent updates so old entries can go"""
+    cmd = """delete from processed_update
+        where processed_time < now() - %s * interval '1 day'"""
+    with conn:
+        with conn.cursor() as crs:
+            crs.execute(cmd, [days])
@@ -0,0 +1,281 @@
+"""Query plan regression check for the statements in postgres_funcs.
+
+Seeds the database in the POSTGRES_* env vars with a large synthetic dataset, then
+calls every postgres_funcs function through a connection that runs each statement
+under EXPLAIN (ANALYZE, BUFFERS) first. A statement fails the check if it
+sequentially scans one of the seeded tables or runs over its recorded budget.
+Seq scans of tables under MIN_SEQ_SCAN_ROWS rows are only reported as warnings,
+the planner rightly prefers them there, so smaller --scale runs still pass:
+
+    python3 src/query_plans.py --seed
+    python3 src/query_plans.py --record-budgets
+
+--seed deletes all data in the database first, only point it at a scratch database.
+Without it the checks only write inside a transaction that is rolled back.
+Budgets are kept in query_budgets.json next to this file. They are absolute times
+measured on one machine at --scale 1 and skipped at other scales, record them again
+on the machine running the check.
+"""
+import argparse
+import json
+import os
+import sys
+from typing import Dict, List
+
+from models import Telegram_chat, Telegram_message
+import postgres_funcs as pf
+
+BUDGETS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_budgets.json')
+
+# tables big enough in production that a sequential scan is a regression
+CHECKED_TABLES = {'telegram_user', 'telegram_chat', 'user_in_chat',
+                  'telegram_message', 'user_reacted_to_message'}
+
+# below this many rows a seq scan can be the cheapest plan, so it is only a warning
+MIN_SEQ_SCAN_ROWS = 100000
+
+# functions that read whole tables on purpose
+FULL_SCAN_FUNCTIONS = {'get_user_in_chat_totals'}
+
+# recorded budgets get this much headroom, and never less than MIN_BUDGET_MS
+BUDGET_HEADROOM = 3
+MIN_BUDGET_MS = 5.0
+
+
+class Explaining_cursor(object):
+    """Runs each statement under EXPLAIN ANALYZE inside a savepoint that is rolled back,
+    then runs it for real so the calling function carries on as usual"""
+
+    def __init__(self, crs, plans: List[Dict], function_name: str):
+        self.crs = crs
+        self.plans = plans
+        self.function_name = function_name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return self.crs.__exit__(*exc)
+
+    def execute(self, sql, params=None):
+        self.crs.execute("SAVEPOINT explain_statement")
+        self.crs.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+        plan = self.crs.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        self.crs.execute("ROLLBACK TO SAVEPOINT explain_statement")
+        self.plans.append({'function': self.function_name, 'sql': sql, 'plan': plan[0]})
+        return self.crs.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self.crs, name)
+
+
+class Explaining_connection(object):
+    """Stands in for a psycopg2 connection in postgres_funcs calls.
+    Commits are ignored, so everything the calls write stays in one transaction
+    that run_functions rolls back"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.plans: List[Dict] = []
+        self.function_name = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def commit(self):
+        pass
+
+    def cursor(self):
+        return Explaining_cursor(self.conn.cursor(), self.plans, self.function_name)
+
+    def __getattr__(self, name):
+        return getattr(self.conn, name)
+
+
+def seed(conn, scale: float):
+    """Fills the tables with users, chats, messages and reacts shaped like production"""
+    users = int(200000 * scale)
+    chats = int(5000 * scale)
+    messages = int(1000000 * scale)
+    reacts = int(1000000 * scale)
+    statements = [
+        """INSERT INTO telegram_user (user_id, username, first_name, last_name)
+            SELECT i, 'user' || i, 'first' || i, NULL FROM generate_series(1, %(users)s) i""",
+        """INSERT INTO telegram_chat (chat_id, chat_name)
+            SELECT '-' || i, 'chat ' || i FROM generate_series(1, %(chats)s) i""",
+        # every user is in 5 chats
+        """INSERT INTO user_in_chat (user_id, chat_id, respekt)
+            SELECT u, '-' || (1 + (u * k * 7) %% %(chats)s), (random() * 200)::int - 100
+            FROM generate_series(1, %(users)s) u, generate_series(1, 5) k
+            ON CONFLICT DO NOTHING""",
+        """INSERT INTO telegram_message (message_id, chat_id, author_user_id, message_text, message_time)
+            SELECT i, '-' || (1 + i %% %(chats)s), 1 + (i::bigint * 7919) %% %(users)s, 'message ' || i,
+                now() - random() * interval '30 days'
+            FROM generate_series(1, %(messages)s) i""",
+        """INSERT INTO user_reacted_to_message (user_id, message_id, react_score, react_message_id)
+            SELECT 1 + (random() * (%(users)s - 1))::int, 1 + (random() * (%(messages)s - 1))::int,
+                CASE WHEN random() < 0.8 THEN 1 ELSE -1 END, %(messages)s + i
+            FROM generate_series(1, %(reacts)s) i""",
+    ]
+    pf.clear_all_tables(conn)
+    sizes = {'users': users, 'chats': chats, 'messages': messages, 'reacts': reacts}
+    with conn:
+        with conn.cursor() as crs:
+            for sql in statements:
+                crs.execute(sql, sizes)
+    conn.autocommit = True
+    with conn.cursor() as crs:
+        crs.execute("ANALYZE")
+    conn.autocommit = False
+    print(f"Seeded {users} users, {chats} chats, {messages} messages, {reacts} reacts")
+
+
+def run_functions(conn) -> List[Dict]:
+    """Calls every postgres_funcs function with arguments taken from the seeded data.
+    Nothing they write is committed"""
+    with conn:
+        with conn.cursor() as crs:
+            crs.execute("""SELECT tm.chat_id, tm.author_user_id FROM telegram_message tm
+                JOIN user_reacted_to_message urtm ON urtm.message_id = tm.message_id
+                LIMIT 1""")
+            (chat_id, user_id) = crs.fetchone()
+            crs.execute("SELECT max(message_id) FROM telegram_message")
+            next_message_id = crs.fetchone()[0] + 1
+    explaining = Explaining_connection(conn)
+    user = pf.get_user_by_user_id(user_id, conn)
+    voter = pf.get_user_by_user_id(user_id % 1000 + 1, conn)
+    chat = Telegram_chat(chat_id, 'chat')
+    original = Telegram_message(next_message_id, chat_id, user.id, 'original')
+    reply = Telegram_message(next_message_id + 1, chat_id, voter.id, '+1')
+
+    calls = [
+        ('get_user_by_user_id', lambda c: pf.get_user_by_user_id(user.id, c)),
+        ('get_user_by_username', lambda c: pf.get_user_by_username(user.username, c)),
+        ('get_user_stats', lambda c: pf.get_user_stats(user.username, chat_id, c)),
+        ('get_chat_info', lambda c: pf.get_chat_info(chat_id, c)),
+        ('save_or_create_user', lambda c: pf.save_or_create_user(user, c)),
+        ('does_chat_exist', lambda c: pf.does_chat_exist(chat_id, c)),
+        ('save_or_create_chat', lambda c: pf.save_or_create_chat(chat, c)),
+        ('create_chat_if_not_exists', lambda c: pf.create_chat_if_not_exists(chat_id, c)),
+        ('save_or_create_user_in_chat', lambda c: pf.save_or_create_user_in_chat(user, chat_id, c)),
+        ('user_reply_to_message', lambda c: pf.user_reply_to_message(
+            voter, user, chat, original, reply, 1, c, update_id=next_message_id)),
+        ('get_respekt_for_user_in_chat',
+         lambda c: pf.get_respekt_for_user_in_chat(user.username, chat_id, c)),
+        ('get_respekt_for_users_in_chat', lambda c: pf.get_respekt_for_users_in_chat(chat_id, c)),
+        ('get_message_responses_for_user_in_chat',
+         lambda c: pf.get_message_responses_for_user_in_chat(user.id, chat_id, c)),
+        ('get_user_in_chat_totals', lambda c: pf.get_user_in_chat_totals(c)),
+        ('get_snapshot_watermark', lambda c: pf.get_snapshot_watermark(c)),
+        ('get_recent_processed_update_ids', lambda c: pf.get_recent_processed_update_ids(100, c)),
+        ('delete_old_processed_updates', lambda c: pf.delete_old_processed_updates(7, c)),
+    ]
+    try:
+        for (name, call) in calls:
+            explaining.function_name = name
+            call(explaining)
+    finally:
+        conn.rollback()
+    return explaining.plans
+
+
+def table_rows(conn) -> Dict[str, int]:
+    """The planner's row estimate of each checked table"""
+    with conn:
+        with conn.cursor() as crs:
+            crs.execute("SELECT relname, reltuples::bigint FROM pg_class WHERE relname = ANY(%s)",
+                        [list(CHECKED_TABLES)])
+            return dict(crs.fetchall())
+
+
+def seq_scanned_tables(node: Dict) -> List[str]:
+    tables = []
+    if node.get('Node Type', '').endswith('Seq Scan') and node.get('Relation Name') in CHECKED_TABLES:
+        tables.append(node['Relation Name'])
+    for child in node.get('Plans', []):
+        tables.extend(seq_scanned_tables(child))
+    return tables
+
+
+def statement_keys(plans: List[Dict]) -> List[str]:
+    """function_name:n where n counts the statements run by that function"""
+    counts: Dict[str, int] = {}
+    keys = []
+    for plan in plans:
+        n = counts.get(plan['function'], 0) + 1
+        counts[plan['function']] = n
+        keys.append(f"{plan['function']}:{n}")
+    return keys
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check query plans of postgres_funcs")
+    parser.add_argument('--seed', action='store_true',
+                        help="replace all data with a synthetic dataset first")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="size of the synthetic dataset, 1 is a million messages and reacts")
+    parser.add_argument('--record-budgets', action='store_true',
+                        help=f"save measured times x{BUDGET_HEADROOM} as the new budgets")
+    args = parser.parse_args()
+    if args.record_budgets and args.scale != 1:
+        parser.error("budgets can only be recorded at --scale 1")
+
+    conn = pf.connect_to_postgres()
+    if args.seed:
+        seed(conn, args.scale)
+    plans = run_functions(conn)
+    rows = table_rows(conn)
+    conn.close()
+
+    budgets = {}
+    if args.scale != 1:
+        # the budgets only hold for the plans picked at full size
+        print("Budgets are recorded at --scale 1, only checking seq scans")
+    elif os.path.exists(BUDGETS_FILE) and not args.record_budgets:
+        with open(BUDGETS_FILE) as f:
+            budgets = json.load(f)
+
+    failures = 0
+    recorded = {}
+    for (key, plan) in zip(statement_keys(plans), plans):
+        ms = plan['plan']['Execution Time']
+        recorded[key] = round(max(ms * BUDGET_HEADROOM, MIN_BUDGET_MS), 1)
+        problems = []
+        warnings = []
+        if plan['function'] not in FULL_SCAN_FUNCTIONS:
+            for table in seq_scanned_tables(plan['plan']['Plan']):
+                if rows.get(table, 0) >= MIN_SEQ_SCAN_ROWS:
+                    problems.append(f"seq scan on {table}")
+                else:
+                    warnings.append(f"seq scan on {table} ({rows.get(table, 0)} rows)")
+        budget = budgets.get(key)
+        if budget is not None and ms > budget:
+            problems.append(f"{ms:.1f}ms over budget of {budget}ms")
+        if problems:
+            status = 'FAIL ' + ', '.join(problems + warnings)
+        elif warnings:
+            status = 'warning ' + ', '.join(warnings)
+        else:
+            status = 'ok'
+        failures = failures + (1 if problems else 0)
+        print(f"{key:45s} {ms:9.2f}ms  {status}")
+        if problems:
+            print("    " + " ".join(plan['sql'].split()))
+
+    if args.record_budgets:
+        with open(BUDGETS_FILE, 'w') as f:
+            json.dump(recorded, f, indent=1, sort_keys=True)
+        print(f"Recorded {len(recorded)} budgets to {BUDGETS_FILE}")
+    if failures:
+        print(f"{failures} of {len(plans)} statements failed")
+        sys.exit(1)
+    print(f"All {len(plans)} statements passed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,162 @@
+"""Records incoming updates and replays them through the bot's handlers.
+
+Recording is turned on in bot.main() by setting RECORD_UPDATES_FILE. Every update
+is written as one compact json object per line.
+
+Replaying feeds a recorded file back through the dispatcher as fast as possible
+against the postgres database in the usual POSTGRES_* env vars, using a bot that
+never talks to telegram:
+
+    python3 src/replay.py updates.jsonl --reset --save-expected totals.json
+    python3 src/replay.py updates.jsonl --reset --expected totals.json
+
+The first run records the final user_in_chat totals, later runs compare against
+them and report throughput.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from queue import Queue
+from threading import Lock
+
+import telegram as tg
+
+logger = logging.getLogger(__name__)
+
+
+def _strip_private(value):
+    """Drops the cached _effective_* attributes telegram objects serialize"""
+    if isinstance(value, dict):
+        return {k: _strip_private(v)
+                for k, v in value.items() if not k.startswith('_')}
+    if isinstance(value, list):
+        return [_strip_private(v) for v in value]
+    return value
+
+
+class Update_recorder(object):
+    """Appends every update it sees to a jsonl file"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = Lock()
+        self.count = 0
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def record(self, bot, update: tg.Update):
+        line = json.dumps(_strip_private(update.to_dict()),
+                          separators=(',', ':'), ensure_ascii=False)
+        with self.lock:
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.count = self.count + 1
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+        logger.info(f"Recorded {self.count} updates to {self.path}")
+
+
+class Fake_bot(tg.Bot):
+    """A bot that counts what it would send instead of calling telegram"""
+
+    def __init__(self, username: str):
+        super().__init__(token='123456:replay')
+        self.bot = tg.User(0, 'replay', True, username=username)
+        self.sent_messages = 0
+
+    def send_message(self, chat_id, text, *args, **kwargs):
+        self.sent_messages = self.sent_messages + 1
+
+    def send_chat_action(self, chat_id, action, *args, **kwargs):
+        pass
+
+
+def read_updates(path: str, bot: tg.Bot):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield tg.Update.de_json(json.loads(line), bot)
+
+
+def totals_to_dict(rows) -> dict:
+    return {f"{chat_id}:{user_id}": respekt for (chat_id, user_id, respekt) in rows}
+
+
+def compare_totals(expected: dict, actual: dict) -> list:
+    """Returns a line for every user_in_chat total that differs"""
+    differences = []
+    for key in sorted(set(expected) | set(actual)):
+        if expected.get(key) != actual.get(key):
+            differences.append(
+                f"{key}: expected {expected.get(key)} got {actual.get(key)}")
+    return differences
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay recorded updates through the bot handlers")
+    parser.add_argument('updates', help="jsonl file written by Update_recorder")
+    parser.add_argument('--reset', action='store_true',
+                        help="delete all bot data before replaying")
+    parser.add_argument('--expected',
+                        help="json file of user_in_chat totals to compare against")
+    parser.add_argument('--save-expected',
+                        help="write the final user_in_chat totals to this file")
+    parser.add_argument('--bot-username', default='replaybot',
+                        help="username the commands were addressed to")
+    args = parser.parse_args()
+
+    # imported here since importing bot connects to the database
+    import bot
+    from telegram.ext import Dispatcher
+    from postgres_funcs import clear_all_tables, get_user_in_chat_totals
+    from hot_state import Hot_state
+    from update_log import Recent_updates
+    from vote_limiter import Vote_velocity_detector
+
+    if args.reset:
+        clear_all_tables(bot.conn)
+    # replays always start with nothing cached so runs are comparable
+    bot.hot_state = Hot_state()
+    bot.recent_updates = Recent_updates(bot.PROCESSED_UPDATES_WINDOW)
+    # updates are replayed far faster than they arrived, don't throttle them
+    bot.vote_detector = Vote_velocity_detector(
+        max_votes_per_voter=float('inf'), max_votes_per_target=float('inf'))
+
+    fake_bot = Fake_bot(args.bot_username)
+    dispatcher = Dispatcher(fake_bot, Queue(), workers=0)
+    bot.add_handlers(dispatcher)
+
+    updates = list(read_updates(args.updates, fake_bot))
+    start = time.perf_counter()
+    for update in updates:
+        dispatcher.process_update(update)
+    elapsed = time.perf_counter() - start
+    bot.archiver.close()
+
+    rate = len(updates) / elapsed if elapsed > 0 else 0.0
+    print(f"Replayed {len(updates)} updates in {elapsed:.3f}s "
+          f"({rate:.1f} updates/s), {fake_bot.sent_messages} messages sent")
+
+    totals = totals_to_dict(get_user_in_chat_totals(bot.conn))
+    if args.save_expected:
+        with open(args.save_expected, 'w') as f:
+            json.dump(totals, f, indent=1, sort_keys=True)
+        print(f"Saved {len(totals)} user_in_chat totals to {args.save_expected}")
+
+    if args.expected:
+        with open(args.expected) as f:
+            expected = json.load(f)
+        differences = compare_totals(expected, totals)
+        if differences:
+            print(f"{len(differences)} user_in_chat totals differ:")
+            print("\n".join(differences))
+            sys.exit(1)
+        print(f"All {len(totals)} user_in_chat totals match")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+"""Weekly respekt reports per chat.
+
+Every table is pulled with a single COPY into a pandas DataFrame and all the
+aggregation is done vectorized, so it runs offline against the live database:
+
+    python3 src/report.py reports/ --days 7 --format csv
+
+Writes givers, receivers, vote_ratios, activity_heatmap and top_messages files to
+the output directory, each with a chat_id column. Parquet output needs pyarrow.
+"""
+import argparse
+import io
+import logging
+import os
+import zlib
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from postgres_funcs import connect_to_postgres
+
+logger = logging.getLogger(__name__)
+
+# message text is left out of the bulk copy, it is only fetched for top_messages
+COPY_QUERIES = {
+    'users': """SELECT user_id, username, first_name FROM telegram_user""",
+    'chats': """SELECT chat_id, chat_name FROM telegram_chat""",
+    'messages': """SELECT message_id, chat_id, author_user_id, message_time
+        FROM telegram_message""",
+    'reacts': """SELECT user_id, message_id, react_score, react_message_id
+        FROM user_reacted_to_message""",
+}
+
+COPY_DTYPES = {
+    'users': {'user_id': 'int64', 'username': str, 'first_name': str},
+    'chats': {'chat_id': str, 'chat_name': str},
+    'messages': {'message_id': 'int64', 'chat_id': str, 'author_user_id': 'Int64'},
+    'reacts': {'user_id': 'int64', 'message_id': 'int64',
+               'react_score': 'int64', 'react_message_id': 'Int64'},
+}
+
+
+def copy_to_dataframe(query: str, dtypes: dict, conn, parse_dates=None) -> pd.DataFrame:
+    buffer = io.StringIO()
+    with conn:
+        with conn.cursor() as crs:
+            crs.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", buffer)
+    buffer.seek(0)
+    return pd.read_csv(buffer, dtype=dtypes, parse_dates=parse_dates)
+
+
+def load_tables(conn) -> dict:
+    tables = {}
+    for name, query in COPY_QUERIES.items():
+        parse_dates = ['message_time'] if name == 'messages' else None
+        tables[name] = copy_to_dataframe(query, COPY_DTYPES[name], conn, parse_dates)
+        logger.info(f"Loaded {len(tables[name])} rows of {name}")
+    return tables
+
+
+def votes_since(tables: dict, since: datetime) -> pd.DataFrame:
+    """One row per vote cast since since, with the chat, voter, receiver and vote time.
+    A vote's time is the time of the reply message that cast it"""
+    messages = tables['messages']
+    votes = tables['reacts'].rename(columns={'user_id': 'voter_id'})
+    votes = votes.merge(
+        messages[['message_id', 'chat_id', 'author_user_id']].rename(
+            columns={'author_user_id': 'receiver_id'}),
+        on='message_id')
+    reply_times = messages[['message_id', 'message_time']].rename(
+        columns={'message_id': 'react_message_id', 'message_time': 'vote_time'})
+    votes = votes.merge(reply_times, on='react_message_id', how='left')
+    return votes[votes['vote_time'] >= since]
+
+
+def vote_counts(votes: pd.DataFrame, user_column: str) -> pd.DataFrame:
+    """Upvotes, downvotes, total and net per chat and user_column, highest net first"""
+    counted = votes.assign(
+        upvotes=(votes['react_score'] > 0).astype('int64'),
+        downvotes=(votes['react_score'] < 0).astype('int64'))
+    counts = counted.groupby(['chat_id', user_column], as_index=False).agg(
+        upvotes=('upvotes', 'sum'),
+        downvotes=('downvotes', 'sum'),
+        net=('react_score', 'sum'))
+    counts['total'] = counts['upvotes'] + counts['downvotes']
+    return counts.sort_values(['chat_id', 'net'], ascending=[True, False])
+
+
+def with_names(frame: pd.DataFrame, users: pd.DataFrame, user_column: str) -> pd.DataFrame:
+    names = users.rename(columns={'user_id': user_column})
+    return frame.merge(names, on=user_column, how='left')
+
+
+def vote_ratios(votes: pd.DataFrame) -> pd.DataFrame:
+    ratios = vote_counts(votes.assign(everyone=0), 'everyone').drop(columns='everyone')
+    ratios['upvote_ratio'] = ratios['upvotes'] / ratios['total']
+    return ratios
+
+
+def activity_heatmap(messages: pd.DataFrame, since: datetime) -> pd.DataFrame:
+    """Message counts per chat by day of week (rows) and hour (columns)"""
+    recent = messages[messages['message_time'] >= since]
+    heatmap = pd.crosstab(
+        [recent['chat_id'], recent['message_time'].dt.dayofweek.rename('weekday')],
+        recent['message_time'].dt.hour.rename('hour'))
+    return heatmap.reindex(columns=range(24), fill_value=0).reset_index()
+
+
+def top_messages(votes: pd.DataFrame, top: int) -> pd.DataFrame:
+    scores = votes.groupby(['chat_id', 'message_id', 'receiver_id'], as_index=False).agg(
+        net=('react_score', 'sum'), votes=('react_score', 'size'))
+    scores = scores.sort_values(['chat_id', 'net'], ascending=[True, False])
+    return scores.groupby('chat_id').head(top)
+
+
+def add_message_text(frame: pd.DataFrame, conn) -> pd.DataFrame:
+    """Looks up the text of the few messages in frame, decompressing it if needed"""
+    cmd = """SELECT message_id, message_text, message_text_compressed
+        FROM telegram_message WHERE message_id = ANY(%s)"""
+    with conn:
+        with conn.cursor() as crs:
+            crs.execute(cmd, [frame['message_id'].tolist()])
+            rows = crs.fetchall()
+    texts = {}
+    for (message_id, text, compressed) in rows:
+        if text is None and compressed is not None:
+            text = zlib.decompress(bytes(compressed)).decode('utf-8')
+        texts[message_id] = text
+    return frame.assign(message_text=frame['message_id'].map(texts))
+
+
+def write_report(frame: pd.DataFrame, directory: str, name: str, file_format: str):
+    path = os.path.join(directory, f"{name}.{file_format}")
+    if file_format == 'parquet':
+        frame.to_parquet(path, index=False)
+    else:
+        frame.to_csv(path, index=False)
+    logger.info(f"Wrote {len(frame)} rows to {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write respekt reports per chat")
+    parser.add_argument('output_dir')
+    parser.add_argument('--days', type=int, default=7,
+                        help="how many days back the report covers")
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--top', type=int, default=10,
+                        help="how many messages per chat in top_messages")
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO)
+    os.makedirs(args.output_dir, exist_ok=True)
+    since = datetime.now() - timedelta(days=args.days)
+
+    conn = connect_to_postgres()
+    tables = load_tables(conn)
+    users = tables['users']
+    votes = votes_since(tables, since)
+
+    reports = {
+        'givers': with_names(vote_counts(votes, 'voter_id'), users, 'voter_id'),
+        'receivers': with_names(vote_counts(votes, 'receiver_id'), users, 'receiver_id'),
+        'vote_ratios': vote_ratios(votes).merge(tables['chats'], on='chat_id', how='left'),
+        'activity_heatmap': activity_heatmap(tables['messages'], since),
+        'top_messages': add_message_text(
+            with_names(top_messages(votes, args.top), users, 'receiver_id'), conn),
+    }
+    for name, frame in reports.items():
+        write_report(frame, args.output_dir, name, args.format)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
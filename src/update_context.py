@@ -0,0 +1,52 @@
+import time
+
+import telegram as tg
+
+from models import User, Telegram_chat, user_from_tg_user
+from postgres_funcs import save_or_create_chat, save_or_create_user
+
+
+class Update_context(object):
+    """
+    The user and chat an update came from, resolved once per update.
+    Tracks whether they were saved to the database so handlers don't save them twice
+    """
+    update_id: int
+    user: User
+    chat: Telegram_chat
+    chat_saved: bool
+    user_saved: bool
+    started: float
+
+    def __init__(self, update: tg.Update):
+        message = update.message
+        self.update_id = update.update_id
+        self.user = user_from_tg_user(message.from_user)
+        self.chat = Telegram_chat(str(message.chat_id), message.chat.title)
+        self.chat_saved = False
+        self.user_saved = False
+        self.started = time.perf_counter()
+
+    def ensure_chat_saved(self, conn):
+        if not self.chat_saved:
+            save_or_create_chat(self.chat, conn)
+            self.chat_saved = True
+
+    def ensure_user_saved(self, conn):
+        if not self.user_saved:
+            self.user = save_or_create_user(self.user, conn)
+            self.user_saved = True
+
+    def elapsed(self) -> float:
+        """Seconds since the context was created"""
+        return time.perf_counter() - self.started
+
+
+def context_for(update: tg.Update) -> Update_context:
+    """Returns the context of update, creating it the first time it is asked for"""
+    context = getattr(update, '_update_context', None)
+    if context is None:
+        context = Update_context(update)
+        # kept on the update so every handler group shares it
+        update._update_context = context
+    return context
@@ -0,0 +1,31 @@
+from collections import deque
+from threading import Lock
+from typing import Iterable
+
+
+class Recent_updates(object):
+    """
+    The last capacity update_ids the bot has seen.
+    Sits in front of the processed_update table so a re-delivered update is
+    rejected without a database round trip
+    """
+
+    def __init__(self, capacity: int = 10000, update_ids: Iterable[int] = ()):
+        self.capacity = capacity
+        self.order = deque()
+        self.ids = set()
+        self.lock = Lock()
+        for update_id in update_ids:
+            self.seen(update_id)
+
+    def seen(self, update_id: int) -> bool:
+        """Returns True if update_id was seen before, otherwise remembers it"""
+        with self.lock:
+            if update_id in self.ids:
+                return True
+            self.ids.add(update_id)
+            self.order.append(update_id)
+            if len(self.order) > self.capacity:
+                self.ids.discard(self.order.popleft())
+            return False
+
@@ -0,0 +1,114 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+
+class Sliding_window_counter(object):
+    """
+    Counts events over the last window seconds.
+    The window is split into bucket_count time buckets kept in a ring buffer,
+    so memory is fixed and old events expire a bucket at a time
+    """
+    __slots__ = ('bucket_width', 'counts', 'bucket_ids')
+
+    def __init__(self, window: float, bucket_count: int):
+        self.bucket_width = window / bucket_count
+        self.counts = [0] * bucket_count
+        # which absolute bucket each slot currently holds
+        self.bucket_ids = [-1] * bucket_count
+
+    def add(self, now: float) -> int:
+        """Counts one event at now and returns the total in the window"""
+        bucket_id = int(now // self.bucket_width)
+        slot = bucket_id % len(self.counts)
+        if self.bucket_ids[slot] != bucket_id:
+            self.bucket_ids[slot] = bucket_id
+            self.counts[slot] = 0
+        self.counts[slot] = self.counts[slot] + 1
+        return self.total(now)
+
+    def total(self, now: float) -> int:
+        oldest = int(now // self.bucket_width) - len(self.counts)
+        return sum(count for (count, bucket_id) in zip(self.counts, self.bucket_ids)
+                   if bucket_id > oldest)
+
+
+class Vote_velocity_detector(object):
+    """
+    Throttles votes when a voter gives, or a target receives, too many votes in a chat
+    within window seconds. Only the max_tracked most recently active
+    (voter, chat) and (target, chat) pairs are tracked
+    """
+
+    def __init__(
+            self,
+            window: float = 60,
+            max_votes_per_voter: int = 10,
+            max_votes_per_target: int = 20,
+            bucket_count: int = 12,
+            max_tracked: int = 10000):
+        self.window = window
+        self.max_votes_per_voter = max_votes_per_voter
+        self.max_votes_per_target = max_votes_per_target
+        self.bucket_count = bucket_count
+        self.max_tracked = max_tracked
+        self.counters = OrderedDict()
+        # (kind, user_id, chat_id) -> (times throttled, last time throttled)
+        self.flagged: Dict[Tuple[str, int, str], Tuple[int, float]] = OrderedDict()
+        self.lock = Lock()
+
+    def _counter(self, key: Tuple[str, int, str]) -> Sliding_window_counter:
+        counter = self.counters.get(key)
+        if counter is None:
+            counter = Sliding_window_counter(self.window, self.bucket_count)
+            self.counters[key] = counter
+            if len(self.counters) > self.max_tracked:
+                self.counters.popitem(last=False)
+        else:
+            self.counters.move_to_end(key)
+        return counter
+
+    def _flag(self, key: Tuple[str, int, str], now: float):
+        (times, _) = self.flagged.pop(key, (0, now))
+        self.flagged[key] = (times + 1, now)
+        if len(self.flagged) > self.max_tracked:
+            self.flagged.popitem(last=False)
+
+    def allow_vote(self, voter_id: int, target_id: int, chat_id: str,
+                   now: Optional[float] = None) -> bool:
+        """
+        Returns False if the vote should be dropped. Only allowed votes are counted,
+        so dropped votes from one voter can't use up a target's limit for everyone else
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            voter_key = ('voter', voter_id, chat_id)
+            target_key = ('target', target_id, chat_id)
+            voter_counter = self._counter(voter_key)
+            target_counter = self._counter(target_key)
+            allowed = True
+            if voter_counter.total(now) >= self.max_votes_per_voter:
+                self._flag(voter_key, now)
+                allowed = False
+            if target_counter.total(now) >= self.max_votes_per_target:
+                self._flag(target_key, now)
+                allowed = False
+            if allowed:
+                voter_counter.add(now)
+                target_counter.add(now)
+            return allowed
+
+    def flagged_rates(self, now: Optional[float] = None) -> List[Tuple[str, int, str, int, int]]:
+        """(kind, user_id, chat_id, votes in window, times throttled) for flagged pairs,
+        most recently throttled first"""
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            rates = []
+            for (key, (times, _)) in reversed(self.flagged.items()):
+                counter = self.counters.get(key)
+                in_window = counter.total(now) if counter is not None else 0
+                rates.append(key + (in_window, times))
+            return rates
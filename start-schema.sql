@@ -16,9 +16,17 @@ CREATE TABLE IF NOT EXISTS telegram_chat (
 CREATE TABLE IF NOT EXISTS user_in_chat (
     user_id INTEGER REFERENCES telegram_user(user_id),
     chat_id TEXT REFERENCES telegram_chat(chat_id),
-    karma integer,
+    respekt integer,
     PRIMARY KEY (user_id,chat_id)
 );
+-- databases created before the rename
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM information_schema.columns
+               WHERE table_name = 'user_in_chat' AND column_name = 'karma') THEN
+        ALTER TABLE user_in_chat RENAME COLUMN karma TO respekt;
+    END IF;
+END $$;
 CREATE UNIQUE INDEX IF NOT EXISTS index_user_in_chat_on_chat_id_usr_id
   on user_in_chat(chat_id, user_id);
 
@@ -27,8 +35,10 @@ CREATE TABLE IF NOT EXISTS telegram_message (
     chat_id TEXT REFERENCES telegram_chat(chat_id),
     author_user_id INTEGER REFERENCES telegram_user(user_id),
     message_text TEXT,
+    message_text_compressed BYTEA, -- zlib compressed text when ARCHIVE_TEXT_MODE=compress
     message_time TIMESTAMP default current_timestamp
 );
+ALTER TABLE telegram_message ADD COLUMN IF NOT EXISTS message_text_compressed BYTEA;
 CREATE INDEX IF NOT EXISTS index_telegram_message_on_author_id
   on telegram_message(author_user_id);
 CREATE INDEX IF NOT EXISTS index_telegram_message_on_chat_id
@@ -44,12 +54,20 @@ CREATE TABLE IF NOT EXISTS user_reacted_to_message (
 );
 CREATE INDEX IF NOT EXISTS index_user_reacted_to_message_on_user_id_message_id_react_message_id
   on user_reacted_to_message(message_id, react_message_id, user_id);
+CREATE INDEX IF NOT EXISTS index_user_reacted_to_message_on_user_id_message_id
+  on user_reacted_to_message(user_id, message_id);
 
 -- use trigger to check banned used before allowing user_in_chat to be modified
 -- soon maybe sum should be used for all karma
 /* CREATE TABLE banned_users (
 ) */
 
+-- updates whose vote has been recorded, written in the same transaction as the vote
+CREATE TABLE IF NOT EXISTS processed_update (
+    update_id BIGINT PRIMARY KEY,
+    processed_time TIMESTAMP default current_timestamp
+);
+
 create table IF NOT EXISTS command_used (
     id SERIAL PRIMARY KEY,
     command TEXT, --actual command used
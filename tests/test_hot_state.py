@@ -0,0 +1,81 @@
+from hot_state import Hot_state, SNAPSHOT_MAGIC, load_hot_state
+from models import User
+
+
+def saved_state(path, watermark):
+    state = Hot_state()
+    state.set_leaderboard('-1', [('alice', 'Alice', 3), (None, 'Bob', -1)])
+    state.add_chat('-1')
+    state.add_user(User(11, 'alice', 'Alice', None))
+    state.processed_update(42)
+    state.save(str(path), watermark)
+    return str(path)
+
+
+def test_snapshot_at_current_watermark_is_reused(tmp_path):
+    path = saved_state(tmp_path / 'snapshot', 7)
+    state = load_hot_state(path, 7)
+    assert state.get_leaderboard('-1') == [('alice', 'Alice', 3), (None, 'Bob', -1)]
+    assert state.is_chat_known('-1')
+    assert state.is_user_known(User(11, 'alice', 'Alice', None))
+    assert state.last_update_id == 42
+
+
+def test_snapshot_behind_the_database_only_keeps_last_update_id(tmp_path):
+    path = saved_state(tmp_path / 'snapshot', 7)
+    state = load_hot_state(path, 8)
+    assert state.get_leaderboard('-1') is None
+    assert not state.is_chat_known('-1')
+    assert not state.is_user_known(User(11, 'alice', 'Alice', None))
+    assert state.last_update_id == 42
+
+
+def test_snapshot_at_watermark_zero_keeps_no_known_users_or_chats(tmp_path):
+    # a recreated database also has watermark 0, its users and chats may be gone
+    path = saved_state(tmp_path / 'snapshot', 0)
+    state = load_hot_state(path, 0)
+    assert not state.is_chat_known('-1')
+    assert not state.is_user_known(User(11, 'alice', 'Alice', None))
+    assert state.get_leaderboard('-1') is None
+    assert state.last_update_id == 42
+
+
+def test_snapshot_ahead_of_the_database_is_ignored(tmp_path):
+    path = saved_state(tmp_path / 'snapshot', 7)
+    state = load_hot_state(path, 6)
+    assert state.get_leaderboard('-1') is None
+    assert not state.is_chat_known('-1')
+    assert state.last_update_id == 0
+
+
+def test_missing_or_unreadable_snapshots_start_empty(tmp_path):
+    assert load_hot_state(None, 7).last_update_id == 0
+    assert load_hot_state(str(tmp_path / 'missing'), 7).last_update_id == 0
+    unknown = tmp_path / 'unknown'
+    unknown.write_bytes(b'RSPKSNP1' + b'\x80\x04.')
+    assert load_hot_state(str(unknown), 7).last_update_id == 0
+    malformed = tmp_path / 'malformed'
+    malformed.write_bytes(SNAPSHOT_MAGIC + b'{"watermark": 7, "leaderboards": []}')
+    assert load_hot_state(str(malformed), 7).last_update_id == 0
+
+
+def test_renamed_user_drops_leaderboards_showing_the_old_name():
+    state = Hot_state()
+    state.add_user(User(11, 'alice', 'Alice', None))
+    state.add_user(User(12, 'bob', 'Bob', None))
+    state.set_leaderboard('-1', [('alice', 'Alice', 3)])
+    state.set_leaderboard('-2', [('bob', 'Bob', 1)])
+    state.add_user(User(11, 'alice', 'Alice', None))
+    assert state.get_leaderboard('-1') is not None
+    state.add_user(User(11, 'alice2', 'Alice', None))
+    assert state.get_leaderboard('-1') is None
+    assert state.get_leaderboard('-2') == [('bob', 'Bob', 1)]
+    assert state.is_user_known(User(11, 'alice2', 'Alice', None))
+
+
+def test_invalidated_leaderboard_is_not_saved(tmp_path):
+    state = Hot_state()
+    state.set_leaderboard('-1', [('alice', 'Alice', 3)])
+    state.invalidate_leaderboard('-1')
+    state.save(str(tmp_path / 'snapshot'), 7)
+    assert load_hot_state(str(tmp_path / 'snapshot'), 7).get_leaderboard('-1') is None
@@ -0,0 +1,52 @@
+import threading
+
+import pytest
+
+from inflight import Inflight_updates
+
+
+def test_tracks_updates_while_they_are_processed():
+    inflight = Inflight_updates()
+    seen_inside = []
+
+    def process_update(update):
+        seen_inside.append((inflight.inflight, inflight.processing_updates()))
+        return 'done'
+
+    tracked = inflight.track(process_update)
+    assert tracked('update') == 'done'
+    assert seen_inside == [(1, ['update'])]
+    assert inflight.inflight == 0
+    assert inflight.processing_updates() == []
+    assert inflight.finished == 1
+
+
+def test_failed_updates_are_still_counted_out():
+    inflight = Inflight_updates()
+
+    def process_update(update):
+        raise RuntimeError('handler failed')
+
+    with pytest.raises(RuntimeError):
+        inflight.track(process_update)('update')
+    assert inflight.inflight == 0
+    assert inflight.finished == 1
+
+
+def test_wait_idle_times_out_while_an_update_is_processed():
+    inflight = Inflight_updates()
+    started = threading.Event()
+    release = threading.Event()
+
+    def process_update(update):
+        started.set()
+        release.wait(5)
+
+    worker = threading.Thread(target=inflight.track(process_update), args=('update',))
+    worker.start()
+    started.wait(5)
+    assert not inflight.wait_idle(0.05)
+    assert inflight.processing_updates() == ['update']
+    release.set()
+    assert inflight.wait_idle(5)
+    worker.join()
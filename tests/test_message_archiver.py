@@ -0,0 +1,55 @@
+import zlib
+
+import pytest
+
+from message_archiver import Message_archiver
+
+
+class Closable_connection(object):
+    """Enough of a connection for archivers that never write a batch"""
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def make_archiver():
+    archivers = []
+
+    def make(**kwargs):
+        archiver = Message_archiver(Closable_connection(), **kwargs)
+        archivers.append(archiver)
+        return archiver
+    yield make
+    for archiver in archivers:
+        archiver.close(1)
+
+
+def test_full_keeps_text(make_archiver):
+    assert make_archiver(text_mode='full')._stored_text('hello') == ('hello', None)
+
+
+def test_truncate_keeps_first_characters(make_archiver):
+    archiver = make_archiver(text_mode='truncate', max_text_length=3)
+    assert archiver._stored_text('hello') == ('hel', None)
+    assert archiver._stored_text('hi') == ('hi', None)
+
+
+def test_compress_stores_zlib_of_utf8(make_archiver):
+    (text, compressed) = make_archiver(text_mode='compress')._stored_text('hëllo')
+    assert text is None
+    assert zlib.decompress(compressed).decode('utf-8') == 'hëllo'
+
+
+def test_none_drops_text(make_archiver):
+    assert make_archiver(text_mode='none')._stored_text('hello') == (None, None)
+
+
+def test_missing_text_stays_missing(make_archiver):
+    for mode in ('full', 'truncate', 'compress'):
+        assert make_archiver(text_mode=mode)._stored_text(None) == (None, None)
+
+
+def test_unknown_text_mode_is_rejected():
+    with pytest.raises(ValueError):
+        Message_archiver(Closable_connection(), text_mode='gzip')
@@ -0,0 +1,30 @@
+from update_log import Recent_updates
+
+
+def test_update_is_seen_the_second_time():
+    recent = Recent_updates(10)
+    assert not recent.seen(1)
+    assert recent.seen(1)
+    assert not recent.seen(2)
+
+
+def test_oldest_updates_are_forgotten_past_capacity():
+    recent = Recent_updates(2)
+    for update_id in (1, 2, 3):
+        recent.seen(update_id)
+    assert recent.seen(3)
+    assert recent.seen(2)
+    assert not recent.seen(1)
+
+
+def test_starts_with_given_update_ids():
+    recent = Recent_updates(10, [5, 6])
+    assert recent.seen(5)
+    assert recent.seen(6)
+    assert not recent.seen(7)
+
+
+def test_keeps_newest_of_too_many_initial_ids():
+    recent = Recent_updates(2, [1, 2, 3])
+    assert recent.seen(3)
+    assert not recent.seen(1)
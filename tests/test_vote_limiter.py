@@ -0,0 +1,70 @@
+from vote_limiter import Sliding_window_counter, Vote_velocity_detector
+
+
+def test_counter_counts_events_in_window():
+    counter = Sliding_window_counter(60, 12)
+    for now in (0, 1, 30):
+        counter.add(now)
+    assert counter.total(30) == 3
+    assert counter.total(59.9) == 3
+
+
+def test_counter_expires_events_a_bucket_at_a_time():
+    counter = Sliding_window_counter(60, 12)
+    counter.add(0)
+    counter.add(30)
+    # the bucket holding 0-5s leaves the window at 60s
+    assert counter.total(60) == 1
+    assert counter.total(95) == 0
+
+
+def test_counter_reuses_slots_of_expired_buckets():
+    counter = Sliding_window_counter(60, 12)
+    counter.add(0)
+    counter.add(0)
+    # 60s lands in the same ring slot as 0s and must not add to the old count
+    assert counter.add(60) == 1
+
+
+def test_voter_is_limited_per_chat():
+    detector = Vote_velocity_detector(max_votes_per_voter=3, max_votes_per_target=100)
+    allowed = [detector.allow_vote(1, target, 'chat', now=0) for target in range(10, 15)]
+    assert allowed == [True, True, True, False, False]
+    assert detector.allow_vote(1, 10, 'other chat', now=0)
+
+
+def test_target_is_limited_across_voters():
+    detector = Vote_velocity_detector(max_votes_per_voter=100, max_votes_per_target=3)
+    allowed = [detector.allow_vote(voter, 99, 'chat', now=0) for voter in range(5)]
+    assert allowed == [True, True, True, False, False]
+
+
+def test_dropped_votes_are_not_counted():
+    detector = Vote_velocity_detector(max_votes_per_voter=10, max_votes_per_target=20)
+    allowed = [detector.allow_vote(1, 99, 'chat', now=0) for _ in range(25)]
+    assert sum(allowed) == 10
+    # the abuser's dropped votes don't use up the target's limit for everyone else
+    assert detector.allow_vote(2, 99, 'chat', now=0)
+
+
+def test_votes_are_allowed_again_after_the_window():
+    detector = Vote_velocity_detector(window=60, max_votes_per_voter=2)
+    assert detector.allow_vote(1, 99, 'chat', now=0)
+    assert detector.allow_vote(1, 99, 'chat', now=1)
+    assert not detector.allow_vote(1, 99, 'chat', now=2)
+    assert detector.allow_vote(1, 99, 'chat', now=65)
+
+
+def test_flagged_rates_reports_throttled_pairs():
+    detector = Vote_velocity_detector(max_votes_per_voter=1)
+    detector.allow_vote(1, 99, 'chat', now=0)
+    detector.allow_vote(1, 98, 'chat', now=0)
+    detector.allow_vote(1, 97, 'chat', now=0)
+    assert detector.flagged_rates(now=0) == [('voter', 1, 'chat', 1, 2)]
+
+
+def test_only_max_tracked_pairs_are_kept():
+    detector = Vote_velocity_detector(max_tracked=4)
+    for voter in range(10):
+        detector.allow_vote(voter, 1000 + voter, 'chat', now=0)
+    assert len(detector.counters) == 4